@@ -1,12 +1,23 @@
 import json
 import users_dao
+import categories_dao
+import posters_dao
+import inbox_dao
 import datetime
+import itertools
+import maintenance
+import profiler
+import os
 
 from db import db
+from db import ArchivedPoster
 from db import Asset
 from db import Category
 from db import Poster
-from flask import Flask, request
+from flask import Flask, request, send_from_directory
+from live import start_live_server
+from storage import LocalStorage, storage
+from streaming import compress_response, iter_rows, stream_response
 
 db_filename = "challenge.db"
 app = Flask(__name__)
@@ -16,8 +27,13 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["SQLALCHEMY_ECHO"] = True
 
 db.init_app(app)
+app.after_request(compress_response)
+app.before_request(profiler.start_request_profile)
+app.teardown_request(profiler.stop_request_profile)
 with app.app_context():
     db.create_all()
+    categories_dao.ensure_category_counts()
+    posters_dao.ensure_poster_indexes()
 
 
 # generalized response formats
@@ -72,10 +88,15 @@ def initialize_app():
 
     db.session.commit()
     categories = Category.query.all()
-    json_categories = []
-    for category in categories:
-        json_categories.append(category.serialize())
-    return json.dumps(json_categories)
+    return stream_response(category.stream_serialize() for category in categories)
+
+@app.route("/categories/")
+def get_categories():
+    """
+    Gets every category with the number of upcoming posters and interested users in it, e.g. to show "Music (42)".
+    Counts are kept up to date as data changes, so this does not load any posters or users
+    """
+    return json.dumps(categories_dao.get_category_counts())
 
 @app.route("/category/search/")
 def search_for_category():
@@ -92,15 +113,38 @@ def search_for_category():
     list = []
     for category in categories:
         if category.title.lower().startswith(stringToSearch.lower()):
-            list.append(category.serialize())
-    return json.dumps(list)
+            list.append(category.stream_serialize())
+    return stream_response(list)
+
+@app.route("/posters/calendar")
+def get_posters_calendar():
+    """
+    Gets the posters between the from and to dates (both 'Y-m-d', inclusive, defaulting to the next 7 days), in
+    buckets of the given granularity ("day", "week" or "month"). Every bucket has a count, day buckets also list
+    their posters.
+    """
+    granularity = request.args.get("granularity", "day")
+    if granularity not in posters_dao.CALENDAR_GRANULARITIES:
+        return failure_response("Invalid granularity", 400)
+    try:
+        start = datetime.date.today()
+        if request.args.get("from") is not None:
+            start = datetime.datetime.strptime(request.args.get("from"), "%Y-%m-%d").date()
+        end = start + datetime.timedelta(days=6)
+        if request.args.get("to") is not None:
+            end = datetime.datetime.strptime(request.args.get("to"), "%Y-%m-%d").date()
+    except ValueError:
+        return failure_response("Date object not understandable", 400)
+    if end < start or (end - start).days >= posters_dao.CALENDAR_MAX_DAYS:
+        return failure_response("Invalid date range", 400)
+    return success_response(posters_dao.get_calendar(start, end, granularity))
 
 @app.route("/poster/<int:id>/")
 def get_poster_from_id(id):
     """
-    Gets a specific poster from its unique id
+    Gets a specific poster from its unique id, including posters that have been archived
     """
-    poster = Poster.query.filter_by(id=id).first()
+    poster = posters_dao.get_poster_by_id(id, include_archived=True)
     if poster is None:
         return json.dumps({"error": "Course not found!"})
     return json.dumps(poster.serialize())
@@ -162,7 +206,7 @@ def add_poster_to_saved(id):
             return json.dumps({"error": "Already saved this poster"})
     user.saved_posters.append(poster)
     db.session.commit()
-    return json.dumps(user.serialize())
+    return stream_response(user.stream_serialize())
 
 @app.route("/user/posters/saved/upcoming/")
 def sort_saved_posters_by_upcoming():
@@ -176,16 +220,14 @@ def sort_saved_posters_by_upcoming():
     user = users_dao.get_user_by_session_token(session_token)
     if not user or not user.verify_session_token(session_token):
         return json.dumps({"error": "Invalid session token"})
-    upcoming = []
-    for poster in user.saved_posters:
-        if poster.date > datetime.datetime.now():
-            upcoming.append(poster)
-    return json.dumps(upcoming)
+    upcoming = posters_dao.get_saved_posters_query(user.id).filter(Poster.date > datetime.datetime.now())
+    return stream_response(iter_rows(upcoming, Poster.simple_serialize))
 
 @app.route("/user/posters/saved/past/")
 def sort_saved_posters_by_past():
     """
-    Finds all the saved posters that have already occurred in no particular order.
+    Finds all the saved posters that have already occurred in no particular order. Pass archived=true to also get
+    old posters that have been moved to the archive.
     """
     success, response = extract_token(request)
     if not success:
@@ -194,11 +236,14 @@ def sort_saved_posters_by_past():
     user = users_dao.get_user_by_session_token(session_token)
     if not user or not user.verify_session_token(session_token):
         return json.dumps({"error": "Invalid session token"})
-    past = []
-    for poster in user.saved_posters:
-        if poster.date < datetime.datetime.now():
-            past.append(poster)
-    return json.dumps(past)
+    past = iter_rows(
+        posters_dao.get_saved_posters_query(user.id).filter(Poster.date < datetime.datetime.now()),
+        Poster.simple_serialize
+    )
+    if request.args.get("archived") == "true":
+        archived = iter_rows(posters_dao.get_archived_saved_posters_query(user.id), ArchivedPoster.simple_serialize)
+        past = itertools.chain(past, archived)
+    return stream_response(past)
 
 @app.route("/user/posters/owned/upcoming/")
 def sort_my_posters_by_upcoming():
@@ -212,16 +257,14 @@ def sort_my_posters_by_upcoming():
     user = users_dao.get_user_by_session_token(session_token)
     if not user or not user.verify_session_token(session_token):
         return json.dumps({"error": "Invalid session token"})
-    upcoming = []
-    for poster in user.my_posters:
-        if poster.date > datetime.datetime.now():
-            upcoming.append(poster)
-    return json.dumps(upcoming)
+    upcoming = posters_dao.get_owned_posters_query(user.id).filter(Poster.date > datetime.datetime.now())
+    return stream_response(iter_rows(upcoming, Poster.simple_serialize))
 
 @app.route("/user/posters/owned/past/")
 def sort_my_posters_by_past():
     """
-    Finds all the users posters that already occurred in no particular order.
+    Finds all the users posters that already occurred in no particular order. Pass archived=true to also get
+    old posters that have been moved to the archive.
     """
     success, response = extract_token(request)
     if not success:
@@ -230,11 +273,14 @@ def sort_my_posters_by_past():
     user = users_dao.get_user_by_session_token(session_token)
     if not user or not user.verify_session_token(session_token):
         return json.dumps({"error": "Invalid session token"})
-    past = []
-    for poster in user.my_posters:
-        if poster.date < datetime.datetime.now():
-            past.append(poster)
-    return json.dumps(past)
+    past = iter_rows(
+        posters_dao.get_owned_posters_query(user.id).filter(Poster.date < datetime.datetime.now()),
+        Poster.simple_serialize
+    )
+    if request.args.get("archived") == "true":
+        archived = iter_rows(posters_dao.get_archived_owned_posters_query(user.id), ArchivedPoster.simple_serialize)
+        past = itertools.chain(past, archived)
+    return stream_response(past)
 
 @app.route("/user/posters/poster", methods=["POST"])
 def create_poster():
@@ -277,9 +323,46 @@ def create_poster():
         for category in all_categories:
             if category.title == title:
                 poster.related_categories.append(category)
+    db.session.commit()
+    inbox_dao.fan_out_later(poster.id)
     return json.dumps(poster.serialize())
 
 
+@app.route("/user/inbox/")
+def get_inbox():
+    """
+    Gets the new posters in the users interesting categories, newest first, with the number of unread posters.
+    Pass before=<poster id> to get the page after that poster.
+    """
+    success, response = extract_token(request)
+    if not success:
+        return response
+    session_token = response
+    user = users_dao.get_user_by_session_token(session_token)
+    if not user or not user.verify_session_token(session_token):
+        return json.dumps({"error": "Invalid session token"})
+    before = request.args.get("before", type=int)
+    return json.dumps(inbox_dao.get_inbox(user, before))
+
+@app.route("/user/inbox/read/", methods=["POST"])
+def mark_inbox_read():
+    """
+    Marks the users inbox as read up to and including the poster with the given poster_id
+    """
+    success, response = extract_token(request)
+    if not success:
+        return response
+    session_token = response
+    user = users_dao.get_user_by_session_token(session_token)
+    if not user or not user.verify_session_token(session_token):
+        return json.dumps({"error": "Invalid session token"})
+    body = json.loads(request.data)
+    poster_id = body.get("poster_id")
+    if not isinstance(poster_id, int):
+        return json.dumps({"error": "Invalid Body"})
+    return json.dumps({"last_read_poster_id": inbox_dao.mark_inbox_read(user, poster_id)})
+
+
 def extract_token(request):
     """
     Helper function that extracts the token from the header of a request
@@ -416,5 +499,55 @@ def upload():
     db.session.commit()
     return success_response(asset.serialize(), 201)
 
+@app.route("/uploads/<path:filename>")
+def get_upload(filename):
+    """
+    Serves uploaded images when the local storage backend is used
+    """
+    if not isinstance(storage, LocalStorage):
+        return failure_response("Not found")
+    return send_from_directory(storage.directory, filename)
+
+@app.route("/profiles/")
+def list_profiles():
+    """
+    Lists the collected request profiles. Requires the X-Profile-Token header
+    """
+    if not profiler.is_profile_admin(request):
+        return failure_response("Invalid profile token", 403)
+    profiler.profiler.flush()
+    return success_response(profiler.profiler.list_profiles())
+
+@app.route("/profiles/<name>")
+def get_profile(name):
+    """
+    Downloads a request profile in collapsed-stack format. Requires the X-Profile-Token header
+    """
+    if not profiler.is_profile_admin(request):
+        return failure_response("Invalid profile token", 403)
+    return send_from_directory(profiler.profiler.directory, name, mimetype="text/plain", as_attachment=True)
+
+@app.cli.command("maintenance")
+def maintenance_command():
+    """
+    Runs the maintenance job once (flask --app app maintenance), e.g. from cron
+    """
+    print(maintenance.run_maintenance())
+
+@app.cli.command("enable-incremental-vacuum")
+def enable_incremental_vacuum_command():
+    """
+    Switches the database to incremental auto-vacuum so the maintenance job can reclaim free pages
+    (flask --app app enable-incremental-vacuum). Locks the database while it is rewritten, run it offline
+    """
+    if maintenance.enable_incremental_vacuum():
+        print("Incremental auto-vacuum enabled")
+    else:
+        print("Incremental auto-vacuum already enabled or not supported")
+
 if __name__ == "__main__":
+    # the debug reloader runs the app in a child process, only start the background threads there
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_live_server()
+        maintenance.start_maintenance_thread(app)
     app.run(host="0.0.0.0", port=8000, debug=True)
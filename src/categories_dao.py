@@ -0,0 +1,117 @@
+"""
+DAO (Data Access Object) file
+
+Helper file containing functions for accessing category data in our database
+"""
+
+import datetime
+
+from db import db
+from db import Category
+from db import CategoryCount
+from db import Poster
+from db import get_counts_watermark
+from db import posters_to_categories_association_table
+from db import students_to_categories_association_table
+
+
+def rebuild_category_counts():
+    """
+    Recomputes every category's counts from scratch. Only needed to backfill a database that existed before
+    the category_counts table, the flush hooks in db keep the counts up to date afterwards
+    """
+    now = datetime.datetime.now()
+    posters = dict(
+        db.session.query(posters_to_categories_association_table.c.category_id, db.func.count())
+        .join(Poster, Poster.id == posters_to_categories_association_table.c.poster_id)
+        .filter(Poster.date > now)
+        .group_by(posters_to_categories_association_table.c.category_id)
+        .all()
+    )
+    users = dict(
+        db.session.query(students_to_categories_association_table.c.category_id, db.func.count())
+        .group_by(students_to_categories_association_table.c.category_id)
+        .all()
+    )
+    CategoryCount.query.delete()
+    for (category_id,) in db.session.query(Category.id).all():
+        db.session.add(CategoryCount(
+            category_id=category_id,
+            upcoming_posters=posters.get(category_id, 0),
+            interested_users=users.get(category_id, 0),
+            rolled_until=now
+        ))
+    db.session.commit()
+
+
+def ensure_category_counts():
+    """
+    Backfills the category counts if categories exist but have no counts yet
+    """
+    if CategoryCount.query.first() is None and Category.query.first() is not None:
+        rebuild_category_counts()
+
+
+def roll_category_counts():
+    """
+    Takes posters whose date has passed since the last roll out of the upcoming poster counts. Run by the
+    maintenance job. Only reads posters in that date range, so the cost depends on how many posters just passed
+    """
+    now = datetime.datetime.now()
+    watermark = get_counts_watermark(db.session.connection())
+    if watermark >= now:
+        return
+    # advancing the watermark first takes the write lock, so the passed posters below are read in the same
+    # transaction, and a concurrent roll that read the same watermark matches no rows and gives up
+    claimed = CategoryCount.query.filter(CategoryCount.rolled_until == watermark).update(
+        {CategoryCount.rolled_until: now},
+        synchronize_session=False
+    )
+    if not claimed:
+        db.session.rollback()
+        return
+    passed = (
+        db.session.query(posters_to_categories_association_table.c.category_id, db.func.count())
+        .join(Poster, Poster.id == posters_to_categories_association_table.c.poster_id)
+        .filter(Poster.date > watermark, Poster.date <= now)
+        .group_by(posters_to_categories_association_table.c.category_id)
+        .all()
+    )
+    for category_id, count in passed:
+        CategoryCount.query.filter_by(category_id=category_id).update(
+            {CategoryCount.upcoming_posters: CategoryCount.upcoming_posters - count},
+            synchronize_session=False
+        )
+    db.session.commit()
+
+
+def get_category_counts():
+    """
+    Returns every category with its number of upcoming posters and interested users. Read only: posters that
+    passed since the last roll are subtracted in the same query instead of rolling here
+    """
+    link = posters_to_categories_association_table
+    passed = (
+        db.select(db.func.count())
+        .select_from(link.join(Poster, Poster.id == link.c.poster_id))
+        .where(link.c.category_id == CategoryCount.category_id)
+        .where(Poster.date > CategoryCount.rolled_until, Poster.date <= datetime.datetime.now())
+        .scalar_subquery()
+    )
+    rows = (
+        db.session.query(
+            Category.id, Category.title, CategoryCount.upcoming_posters - passed, CategoryCount.interested_users
+        )
+        .outerjoin(CategoryCount, CategoryCount.category_id == Category.id)
+        .order_by(Category.id)
+        .all()
+    )
+    return [
+        {
+            "id": category_id,
+            "title": title,
+            "upcoming_posters": upcoming_posters or 0,
+            "interested_users": interested_users or 0
+        }
+        for category_id, title, upcoming_posters, interested_users in rows
+    ]
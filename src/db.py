@@ -1,6 +1,8 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, attributes
 import base64
-import boto3
 import datetime
 import io
 from io import BytesIO
@@ -8,31 +10,47 @@ from mimetypes import guess_extension, guess_type
 import os
 from PIL import Image
 import random
+import sqlite3
 import re
 import string
 import hashlib
 import bcrypt
+from live import hub
+from storage import storage
+from streaming import iter_rows
 
 db = SQLAlchemy()
 
+
+@event.listens_for(Engine, "connect")
+def enable_sqlite_wal(dbapi_connection, connection_record):
+    """
+    Puts SQLite databases in WAL mode, so readers (e.g. a streamed response still reading its rows) don't block
+    writers and writers don't block readers
+    """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.close()
+
 EXTENSIONS = ["png", "gif", "jpg", "jpeg"]
-BASE_DIR = os.getcwd()
-S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
-S3_BASE_URL = f"https://{S3_BUCKET_NAME}.s3.us-east-1.amazonaws.com"
+S3_BASE_URL = storage.base_url
 
 
 posters_to_categories_association_table = db.Table(
     "posters_to_categories_association",
     db.Model.metadata,
     db.Column("poster_id", db.Integer, db.ForeignKey("posters.id")),
-    db.Column("category_id", db.Integer, db.ForeignKey("categories.id"))
+    db.Column("category_id", db.Integer, db.ForeignKey("categories.id")),
+    db.Index("ix_posters_to_categories_association_category_poster", "category_id", "poster_id")
 )
 
 students_to_categories_association_table = db.Table(
     "students_to_categories_association",
     db.Model.metadata,
     db.Column("user_id", db.Integer, db.ForeignKey("users.id")),
-    db.Column("category_id", db.Integer, db.ForeignKey("categories.id"))
+    db.Column("category_id", db.Integer, db.ForeignKey("categories.id")),
+    db.Index("ix_students_to_categories_association_category_user", "category_id", "user_id")
 )
 
 posters_to_users_association_table = db.Table(
@@ -81,7 +99,7 @@ class Asset(db.Model):
         Given an image in bas64 form, does the following
         1. Rejects the image if it's not supported filetype
         2. Generates a random string for the image filename
-        3. Decodes the image and attempts to upload it to AWS
+        3. Decodes the image and attempts to upload it to the storage backend
         """
         try:
             ext = guess_extension(guess_type(image_data)[0])[1:]
@@ -108,26 +126,19 @@ class Asset(db.Model):
             self.created_at = datetime.datetime.now()
 
             img_filename = f"{self.salt}.{self.extension}"
-            self.upload(img, img_filename)
+            self.upload(img, img_filename, guess_type(image_data)[0])
         except Exception as e:
             print(f"Error while creating image: {e}")
 
-    def upload(self, img, img_filename):
+    def upload(self, img, img_filename, content_type=None):
         """
-        Attempt to upload the image into an S3 bucket 
+        Attempt to upload the image to the storage backend. The image is re-encoded in memory first, which drops
+        its metadata (e.g. EXIF GPS tags) and any bytes appended after it
         """
         try:
-            img_temploc = f"{BASE_DIR}/{img_filename}"
-            img.save(img_temploc)
-
-            s3_client = boto3.client("s3")
-            s3_client.upload_file(img_temploc, S3_BUCKET_NAME, img_filename)
-
-            s3_resource = boto3.resource("s3")
-            object_acl = s3_resource.ObjectAcl(S3_BUCKET_NAME, img_filename)
-            object_acl.put(ACL="public-read")
-
-            os.remove(img_temploc)
+            buf = BytesIO()
+            img.save(buf, format=img.format)
+            storage.save(buf.getvalue(), img_filename, content_type)
         except Exception as e:
             print(f"Error while uploading image: {e}")
 
@@ -146,7 +157,7 @@ class Poster(db.Model):
     number_of_likes = db.Column(db.Integer, nullable=False)
     number_of_views = db.Column(db.Integer, nullable=False)
     author = db.Column(db.String, nullable=False)
-    date = db.Column(db.DateTime, nullable=False)
+    date = db.Column(db.DateTime, nullable=False, index=True)
     location = db.Column(db.String, nullable=False)
     description = db.Column(db.String, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
@@ -265,6 +276,26 @@ class User(db.Model):
             "saved_posters": [p.simple_serialize() for p in self.saved_posters]
         }
 
+    def stream_serialize(self):
+        """
+        Complete serialize of User object that reads the posters lazily, for streamed responses
+        """
+        pic = "None"
+        if self.profile_pic is not None:
+            pic = self.profile_pic.serialize()
+        saved_posters = Poster.query.join(
+            posters_to_users_association_table, posters_to_users_association_table.c.poster_id == Poster.id
+        ).filter(posters_to_users_association_table.c.user_id == self.id)
+        return {
+            "id": self.id,
+            "email": self.email,
+            "display_name": self.display_name,
+            "profile_pic": pic,
+            "my_posters": iter_rows(Poster.query.filter_by(user_id=self.id), Poster.simple_serialize),
+            "interesting_categories": [c.simple_serialize() for c in self.interesting_categories],
+            "saved_posters": iter_rows(saved_posters, Poster.simple_serialize)
+        }
+
     def simple_serialize(self):
         """
         Simple serialize of User object
@@ -348,3 +379,318 @@ class Category(db.Model):
             "posters_with_category": [p.simple_serialize() for p in self.posters_with_category],
             "users_with_category": [u.simple_serialize() for u in self.users_with_category]
         }
+
+    def stream_serialize(self):
+        """
+        Complete serialize of Category object that reads the posters and users lazily, for streamed responses
+        """
+        posters = Poster.query.join(
+            posters_to_categories_association_table, posters_to_categories_association_table.c.poster_id == Poster.id
+        ).filter(posters_to_categories_association_table.c.category_id == self.id)
+        users = User.query.join(
+            students_to_categories_association_table, students_to_categories_association_table.c.user_id == User.id
+        ).filter(students_to_categories_association_table.c.category_id == self.id)
+        return {
+            "id": self.id,
+            "title": self.title,
+            "posters_with_category": iter_rows(posters, Poster.simple_serialize),
+            "users_with_category": iter_rows(users, User.simple_serialize)
+        }
+
+
+class CategoryCount(db.Model):
+    """
+    Category count model
+    Aggregate row per category holding the number of upcoming posters and interested users.
+    Kept up to date by the flush hooks below, so reading counts never touches posters or users.
+    Posters are counted as upcoming while their date is after rolled_until; the maintenance job calls
+    categories_dao.roll_category_counts to move rolled_until forward and take out posters whose date has passed.
+    """
+    __tablename__ = "category_counts"
+    category_id = db.Column(db.Integer, db.ForeignKey("categories.id"), primary_key=True)
+    upcoming_posters = db.Column(db.Integer, nullable=False, default=0)
+    interested_users = db.Column(db.Integer, nullable=False, default=0)
+    rolled_until = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self, **kwargs):
+        """
+        Initialize CategoryCount object
+        """
+        self.category_id = kwargs.get("category_id")
+        self.upcoming_posters = kwargs.get("upcoming_posters", 0)
+        self.interested_users = kwargs.get("interested_users", 0)
+        self.rolled_until = kwargs.get("rolled_until")
+
+
+class InboxItem(db.Model):
+    """
+    Inbox Item model
+    A new poster in one of a user's interesting categories, written by the fan-out worker in inbox_dao.
+    Items are read newest poster first through the (user_id, poster_id) index
+    """
+    __tablename__ = "inbox_items"
+    __table_args__ = (db.UniqueConstraint("user_id", "poster_id"),)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    poster_id = db.Column(db.Integer, db.ForeignKey("posters.id"), nullable=False, index=True)
+
+    def __init__(self, **kwargs):
+        """
+        Initialize InboxItem object
+        """
+        self.user_id = kwargs.get("user_id")
+        self.poster_id = kwargs.get("poster_id")
+
+
+class InboxState(db.Model):
+    """
+    Inbox State model
+    The newest poster a user has read in their inbox, everything after it is unread
+    """
+    __tablename__ = "inbox_states"
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    last_read_poster_id = db.Column(db.Integer, nullable=False, default=0)
+
+    def __init__(self, **kwargs):
+        """
+        Initialize InboxState object
+        """
+        self.user_id = kwargs.get("user_id")
+        self.last_read_poster_id = kwargs.get("last_read_poster_id", 0)
+
+
+archived_posters_to_categories_association_table = db.Table(
+    "posters_to_categories_association_archive",
+    db.Model.metadata,
+    db.Column("poster_id", db.Integer, db.ForeignKey("posters_archive.id"), index=True),
+    db.Column("category_id", db.Integer, db.ForeignKey("categories.id"))
+)
+
+archived_posters_to_users_association_table = db.Table(
+    "posters_to_users_association_archive",
+    db.Model.metadata,
+    db.Column("user_id", db.Integer, db.ForeignKey("users.id"), index=True),
+    db.Column("poster_id", db.Integer, db.ForeignKey("posters_archive.id"), index=True)
+)
+
+
+class ArchivedAsset(db.Model):
+    """
+    Archived Asset model
+    Poster pictures of archived posters, moved out of assets by the maintenance job. The image files themselves
+    are left where they are
+    """
+    __tablename__ = "assets_archive"
+    id = db.Column(db.Integer, primary_key=True)
+    base_url = db.Column(db.String, nullable=True)
+    salt = db.Column(db.String, nullable=False)
+    extension = db.Column(db.String, nullable=False)
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    poster_id = db.Column(db.Integer, db.ForeignKey("posters_archive.id"), index=True)
+
+    serialize = Asset.serialize
+
+
+class ArchivedPoster(db.Model):
+    """
+    Archived Poster model
+    Posters whose date is long past, moved out of posters by the maintenance job together with their
+    category links, saves and poster picture. Serializes the same way as Poster
+    """
+    __tablename__ = "posters_archive"
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String, nullable=False)
+    number_of_likes = db.Column(db.Integer, nullable=False)
+    number_of_views = db.Column(db.Integer, nullable=False)
+    author = db.Column(db.String, nullable=False)
+    date = db.Column(db.DateTime, nullable=False, index=True)
+    location = db.Column(db.String, nullable=False)
+    description = db.Column(db.String, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False, index=True)
+    related_categories = db.relationship("Category", secondary=archived_posters_to_categories_association_table)
+    poster_pic = db.relationship("ArchivedAsset", uselist=False)
+    users_saved_to = db.relationship("User", secondary=archived_posters_to_users_association_table)
+
+    serialize = Poster.serialize
+    simple_serialize = Poster.simple_serialize
+
+
+def get_counts_watermark(connection):
+    """
+    Returns the time up to which passed posters have been taken out of the category counts
+    """
+    watermark = connection.execute(db.select(db.func.min(CategoryCount.rolled_until))).scalar()
+    if watermark is None:
+        return datetime.datetime.now()
+    return watermark
+
+
+def _collection_change(obj, key, old_counted, new_counted):
+    """
+    Returns the categories to decrement and increment for a change to obj.<key>, where old_counted/new_counted
+    say whether obj counted towards its categories before and after the flush
+    """
+    history = attributes.get_history(obj, key)
+    old = list(history.unchanged or ()) + list(history.deleted or ())
+    new = list(history.unchanged or ()) + list(history.added or ())
+    return (old if old_counted else []), (new if new_counted else [])
+
+
+@event.listens_for(Poster.date, "set", active_history=True)
+def load_previous_poster_date(target, value, oldvalue, initiator):
+    """
+    Makes SQLAlchemy load a poster's old date when it is changed, so the flush hooks can tell whether it used to
+    be upcoming
+    """
+
+
+def _link_history(obj, key, session):
+    """
+    Returns the (added, removed) objects of the obj.<key> relationship in this flush. Unchanged relationships of
+    persistent objects are not loaded
+    """
+    if obj in session.deleted:
+        history = attributes.get_history(obj, key)
+        return [], list(history.unchanged or ()) + list(history.deleted or ())
+    if obj not in session.new and not attributes.instance_state(obj).attrs[key].history.has_changes():
+        return [], []
+    history = attributes.get_history(obj, key)
+    return list(history.added or ()), list(history.deleted or ())
+
+
+def _committed_date(poster):
+    """
+    Returns a poster's date as it was before this flush
+    """
+    history = attributes.instance_state(poster).attrs.date.history
+    return history.deleted[0] if history.deleted else poster.date
+
+
+@event.listens_for(Session, "before_flush")
+def collect_category_count_changes(session, flush_context, instances):
+    """
+    Works out how each category's counts change in this flush. Link changes are collected as (poster, category)
+    and (user, category) pairs from both sides of the relationships, so a link changed through Category and seen
+    again through the backref on Poster/User is only counted once
+    """
+    changes = []
+    watermark = None
+
+    def upcoming(date):
+        nonlocal watermark
+        if watermark is None:
+            watermark = get_counts_watermark(session.connection())
+        return date is not None and date > watermark
+
+    poster_links = {}
+    user_links = {}
+    moved_posters = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Poster):
+            date_history = attributes.instance_state(obj).attrs.date.history
+            if obj not in session.new and obj not in session.deleted and date_history.has_changes():
+                # a poster whose date changed is redone from its full before/after category lists
+                moved_posters.add(obj)
+                removed, added = _collection_change(
+                    obj, "related_categories", upcoming(_committed_date(obj)), upcoming(obj.date)
+                )
+                changes.extend(("upcoming_posters", c, -1) for c in removed)
+                changes.extend(("upcoming_posters", c, 1) for c in added)
+                continue
+            added, removed = _link_history(obj, "related_categories", session)
+            poster_links.update({(obj, c): 1 for c in added})
+            poster_links.update({(obj, c): -1 for c in removed})
+        elif isinstance(obj, User):
+            added, removed = _link_history(obj, "interesting_categories", session)
+            user_links.update({(obj, c): 1 for c in added})
+            user_links.update({(obj, c): -1 for c in removed})
+        elif isinstance(obj, Category):
+            added, removed = _link_history(obj, "posters_with_category", session)
+            poster_links.update({(p, obj): 1 for p in added})
+            poster_links.update({(p, obj): -1 for p in removed})
+            added, removed = _link_history(obj, "users_with_category", session)
+            user_links.update({(u, obj): 1 for u in added})
+            user_links.update({(u, obj): -1 for u in removed})
+
+    for (poster, category), delta in poster_links.items():
+        if poster not in moved_posters and upcoming(_committed_date(poster)):
+            changes.append(("upcoming_posters", category, delta))
+    for (user, category), delta in user_links.items():
+        changes.append(("interested_users", category, delta))
+
+    new_categories = [obj for obj in session.new if isinstance(obj, Category)]
+    deleted_categories = [obj.id for obj in session.deleted if isinstance(obj, Category)]
+    if changes or new_categories or deleted_categories:
+        session.info["category_count_changes"] = (changes, new_categories, deleted_categories)
+
+
+@event.listens_for(Session, "after_flush")
+def apply_category_count_changes(session, flush_context):
+    """
+    Applies the changes collected in collect_category_count_changes, in the same transaction as the flush
+    """
+    pending = session.info.pop("category_count_changes", None)
+    if pending is None:
+        return
+    changes, new_categories, deleted_categories = pending
+    connection = session.connection()
+    table = CategoryCount.__table__
+
+    if new_categories:
+        watermark = get_counts_watermark(connection)
+        connection.execute(table.insert(), [
+            {"category_id": c.id, "upcoming_posters": 0, "interested_users": 0, "rolled_until": watermark}
+            for c in new_categories
+        ])
+    if deleted_categories:
+        connection.execute(table.delete().where(table.c.category_id.in_(deleted_categories)))
+
+    totals = {}
+    for column, category, delta in changes:
+        if category.id in deleted_categories:
+            continue
+        key = (column, category.id)
+        totals[key] = totals.get(key, 0) + delta
+    for (column, category_id), delta in totals.items():
+        if delta == 0:
+            continue
+        connection.execute(
+            table.update()
+            .where(table.c.category_id == category_id)
+            .values({column: table.c[column] + delta})
+        )
+
+
+@event.listens_for(Session, "after_flush")
+def collect_live_counts(session, flush_context):
+    """
+    Remembers the like/view counts of posters flushed in this transaction, the latest flush winning
+    """
+    for poster in session.dirty:
+        if not isinstance(poster, Poster):
+            continue
+        state = attributes.instance_state(poster)
+        if state.attrs.number_of_likes.history.has_changes() or state.attrs.number_of_views.history.has_changes():
+            counts = session.info.setdefault("live_counts", {})
+            counts[poster.id] = (poster.number_of_likes, poster.number_of_views)
+
+
+@event.listens_for(Session, "after_commit")
+def publish_live_counts(session):
+    """
+    Publishes the counts stored by the committed transaction to the live stream
+    """
+    for poster_id, (number_of_likes, number_of_views) in session.info.pop("live_counts", {}).items():
+        hub.publish(poster_id, number_of_likes, number_of_views)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def discard_live_counts(session, previous_transaction):
+    """
+    Forgets the counts of a rolled back transaction
+    """
+    session.info.pop("live_counts", None)
@@ -0,0 +1,209 @@
+"""
+DAO (Data Access Object) file
+
+Helper file containing functions for the users' inboxes of new posters in their interesting categories.
+
+New posters are fanned out to the inbox_items of every subscriber by a background worker, in batched inserts.
+Categories with more than INBOX_FANOUT_LIMIT interested users are not fanned out, their posters are merged into
+the inbox when it is read instead. Each inbox keeps at most INBOX_MAX_ITEMS items.
+"""
+
+import os
+import queue
+import threading
+
+from db import db
+from db import CategoryCount
+from db import InboxItem
+from db import InboxState
+from db import Poster
+from db import posters_to_categories_association_table
+from db import students_to_categories_association_table
+from flask import current_app
+
+INBOX_FANOUT_LIMIT = int(os.environ.get("INBOX_FANOUT_LIMIT", "10000"))
+INBOX_BATCH_SIZE = 500
+INBOX_MAX_ITEMS = 500
+INBOX_PAGE_SIZE = 50
+
+_fanout_queue = queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_category_ids(poster_id):
+    """
+    Returns the ids of a poster's categories
+    """
+    rows = db.session.query(posters_to_categories_association_table.c.category_id).filter(
+        posters_to_categories_association_table.c.poster_id == poster_id
+    ).all()
+    return [category_id for (category_id,) in rows]
+
+
+def get_large_category_ids(category_ids):
+    """
+    Returns which of the given categories have too many interested users to fan out to
+    """
+    if not category_ids:
+        return []
+    rows = db.session.query(CategoryCount.category_id).filter(
+        CategoryCount.category_id.in_(category_ids),
+        CategoryCount.interested_users > INBOX_FANOUT_LIMIT
+    ).all()
+    return [category_id for (category_id,) in rows]
+
+
+def trim_inboxes(user_ids):
+    """
+    Deletes the oldest items of the given users' inboxes past INBOX_MAX_ITEMS. Each user costs one probe of the
+    (user_id, poster_id) index for the first poster past the cap, so inboxes under the cap are not touched
+    """
+    table = InboxItem.__table__
+    newer = table.alias("newer")
+    cutoff = (
+        db.select(newer.c.poster_id)
+        .where(newer.c.user_id == db.bindparam("trim_user_id"))
+        .order_by(newer.c.poster_id.desc())
+        .limit(1)
+        .offset(INBOX_MAX_ITEMS)
+        .scalar_subquery()
+    )
+    db.session.execute(
+        table.delete()
+        .where(table.c.user_id == db.bindparam("trim_user_id"))
+        .where(table.c.poster_id <= cutoff),
+        [{"trim_user_id": user_id} for user_id in user_ids]
+    )
+
+
+def fan_out_poster(poster_id):
+    """
+    Writes a poster into the inboxes of the users interested in its categories, INBOX_BATCH_SIZE users at a time
+
+    Returns the number of inbox items written
+    """
+    poster = Poster.query.filter_by(id=poster_id).first()
+    if poster is None:
+        return 0
+    category_ids = get_category_ids(poster_id)
+    large = get_large_category_ids(category_ids)
+    category_ids = [category_id for category_id in category_ids if category_id not in large]
+    if not category_ids:
+        return 0
+
+    subscribers = (
+        db.session.query(students_to_categories_association_table.c.user_id)
+        .filter(students_to_categories_association_table.c.category_id.in_(category_ids))
+        .filter(students_to_categories_association_table.c.user_id != poster.user_id)
+        .distinct()
+        .order_by(students_to_categories_association_table.c.user_id)
+    )
+    total = 0
+    last_user_id = 0
+    while True:
+        user_ids = [
+            user_id for (user_id,) in
+            subscribers.filter(students_to_categories_association_table.c.user_id > last_user_id)
+            .limit(INBOX_BATCH_SIZE)
+            .all()
+        ]
+        if not user_ids:
+            return total
+        db.session.execute(
+            InboxItem.__table__.insert().prefix_with("OR IGNORE", dialect="sqlite"),
+            [{"user_id": user_id, "poster_id": poster_id} for user_id in user_ids]
+        )
+        trim_inboxes(user_ids)
+        db.session.commit()
+        total += len(user_ids)
+        last_user_id = user_ids[-1]
+
+
+def _run_worker(app):
+    """
+    Fan-out worker loop
+    """
+    while True:
+        poster_id = _fanout_queue.get()
+        with app.app_context():
+            try:
+                fan_out_poster(poster_id)
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error while fanning out poster {poster_id}: {e}")
+        _fanout_queue.task_done()
+
+
+def fan_out_later(poster_id):
+    """
+    Queues a committed poster for fan-out on the background worker, starting the worker if needed
+    """
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            app = current_app._get_current_object()
+            _worker = threading.Thread(target=_run_worker, args=(app,), daemon=True)
+            _worker.start()
+    _fanout_queue.put(poster_id)
+
+
+def _get_followed_large_category_ids(user):
+    """
+    Returns the user's interesting categories whose posters are merged in when reading instead of fanned out
+    """
+    return get_large_category_ids([c.id for c in user.interesting_categories])
+
+
+def get_inbox(user, before=None, limit=INBOX_PAGE_SIZE):
+    """
+    Returns a page of the user's inbox, newest poster first, and how many posters are unread.
+    Pass the poster id of the last item as before to get the next page
+    """
+    state = InboxState.query.filter_by(user_id=user.id).first()
+    last_read = state.last_read_poster_id if state is not None else 0
+
+    posters = Poster.query.join(InboxItem, InboxItem.poster_id == Poster.id).filter(InboxItem.user_id == user.id)
+    unread = db.session.query(InboxItem.poster_id).filter(InboxItem.user_id == user.id, InboxItem.poster_id > last_read)
+    queries = [posters.order_by(InboxItem.poster_id.desc())]
+
+    large = _get_followed_large_category_ids(user)
+    if large:
+        link = posters_to_categories_association_table
+        large_posters = (
+            Poster.query.join(link, link.c.poster_id == Poster.id)
+            .filter(link.c.category_id.in_(large), Poster.user_id != user.id)
+        )
+        queries.append(large_posters.order_by(link.c.poster_id.desc()))
+        # a poster can be both fanned out and in a large category, so unread posters are counted as a union of ids
+        unread = unread.union(
+            db.session.query(link.c.poster_id)
+            .join(Poster, Poster.id == link.c.poster_id)
+            .filter(link.c.category_id.in_(large), link.c.poster_id > last_read, Poster.user_id != user.id)
+        )
+
+    merged = {}
+    for query in queries:
+        if before is not None:
+            query = query.filter(Poster.id < before)
+        for poster in query.limit(limit).all():
+            merged[poster.id] = poster
+    page = sorted(merged.values(), key=lambda p: p.id, reverse=True)[:limit]
+
+    return {
+        "unread_count": unread.limit(INBOX_MAX_ITEMS).count(),
+        "posters": [dict(p.simple_serialize(), unread=p.id > last_read) for p in page]
+    }
+
+
+def mark_inbox_read(user, poster_id):
+    """
+    Marks every poster in the user's inbox up to poster_id as read
+    """
+    state = InboxState.query.filter_by(user_id=user.id).first()
+    if state is None:
+        state = InboxState(user_id=user.id)
+        db.session.add(state)
+    state.last_read_poster_id = max(state.last_read_poster_id or 0, poster_id)
+    db.session.commit()
+    return state.last_read_poster_id
@@ -0,0 +1,251 @@
+"""
+Live counter stream
+
+In-process pub/sub for poster like/view counts, plus a small asyncio
+Server-Sent Events server that runs next to the Flask app. Each connection is
+a coroutine rather than a thread, so thousands of idle subscribers are cheap.
+
+GET /posters/live?ids=1,2,3 on LIVE_PORT streams events of the form
+
+    event: counts
+    data: {"id": 1, "number_of_likes": 4, "number_of_views": 20}
+"""
+
+import asyncio
+import json
+import os
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+LIVE_HOST = os.environ.get("LIVE_HOST", "0.0.0.0")
+LIVE_PORT = int(os.environ.get("LIVE_PORT", "8001"))
+COALESCE_INTERVAL = 1.0
+KEEPALIVE_INTERVAL = 15.0
+MAX_IDS_PER_STREAM = 100
+
+
+class Subscriber:
+    """
+    A single SSE connection, holding the latest unsent counts per poster
+    """
+
+    def __init__(self, poster_ids):
+        """
+        Initialize Subscriber object
+        """
+        self.poster_ids = poster_ids
+        self.pending = {}
+        self.event = asyncio.Event()
+
+    def push(self, poster_id, counts):
+        """
+        Records new counts for a poster, replacing any that were not sent yet
+        """
+        self.pending[poster_id] = counts
+        self.event.set()
+
+    def drain(self):
+        """
+        Returns and clears the unsent counts
+        """
+        pending = self.pending
+        self.pending = {}
+        self.event.clear()
+        return pending
+
+
+class CounterHub:
+    """
+    Pub/sub hub for poster counters
+
+    publish() may be called from any thread (e.g. Flask request threads).
+    Updates are coalesced per poster and flushed to subscribers at most once
+    every COALESCE_INTERVAL seconds by the event loop.
+    """
+
+    def __init__(self):
+        """
+        Initialize CounterHub object
+        """
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._subscribers = {}
+
+    def publish(self, poster_id, number_of_likes, number_of_views):
+        """
+        Records the latest counts for a poster
+        """
+        if poster_id is None:
+            return
+        with self._lock:
+            self._pending[poster_id] = {
+                "id": poster_id,
+                "number_of_likes": number_of_likes,
+                "number_of_views": number_of_views
+            }
+
+    def subscribe(self, poster_ids):
+        """
+        Registers a new subscriber for the given poster ids (event loop only)
+        """
+        subscriber = Subscriber(poster_ids)
+        for poster_id in poster_ids:
+            self._subscribers.setdefault(poster_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """
+        Removes a subscriber (event loop only)
+        """
+        for poster_id in subscriber.poster_ids:
+            subscribers = self._subscribers.get(poster_id)
+            if subscribers is None:
+                continue
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[poster_id]
+
+    def flush(self):
+        """
+        Pushes the coalesced updates to their subscribers (event loop only)
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+        for poster_id, counts in pending.items():
+            for subscriber in self._subscribers.get(poster_id, ()):
+                subscriber.push(poster_id, counts)
+
+    async def run_flusher(self):
+        """
+        Flushes pending updates every COALESCE_INTERVAL seconds
+        """
+        while True:
+            await asyncio.sleep(COALESCE_INTERVAL)
+            self.flush()
+
+
+hub = CounterHub()
+
+
+def parse_ids(query):
+    """
+    Parses the ids query parameter ("1,2,3") into a list of at most MAX_IDS_PER_STREAM poster ids
+    """
+    values = parse_qs(query).get("ids", [])
+    ids = []
+    seen = set()
+    for value in values:
+        for part in value.split(","):
+            part = part.strip()
+            if not part.isdigit():
+                continue
+            poster_id = int(part)
+            if poster_id in seen:
+                continue
+            seen.add(poster_id)
+            ids.append(poster_id)
+            if len(ids) >= MAX_IDS_PER_STREAM:
+                return ids
+    return ids
+
+
+async def write_response(writer, status, body):
+    """
+    Writes a plain JSON response and closes the connection
+    """
+    data = json.dumps(body).encode("utf8")
+    writer.write(
+        f"HTTP/1.1 {status}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(data)}\r\n"
+        "Connection: close\r\n\r\n".encode("utf8") + data
+    )
+    await writer.drain()
+    writer.close()
+
+
+async def handle_connection(reader, writer):
+    """
+    Handles a single HTTP connection to the live server
+    """
+    try:
+        try:
+            request_line = await reader.readline()
+        except (ValueError, asyncio.LimitOverrunError):
+            await write_response(writer, "414 URI Too Long", {"error": "Request line too long"})
+            return
+        while True:
+            try:
+                line = await reader.readline()
+            except (ValueError, asyncio.LimitOverrunError):
+                await write_response(writer, "400 Bad Request", {"error": "Header line too long"})
+                return
+            if not line or line in (b"\r\n", b"\n"):
+                break
+        parts = request_line.decode("latin-1").split()
+        if len(parts) < 2 or parts[0] != "GET":
+            await write_response(writer, "405 Method Not Allowed", {"error": "Method not allowed"})
+            return
+        url = urlsplit(parts[1])
+        if url.path.rstrip("/") != "/posters/live":
+            await write_response(writer, "404 Not Found", {"error": "Not found"})
+            return
+        poster_ids = parse_ids(url.query)
+        if not poster_ids:
+            await write_response(writer, "400 Bad Request", {"error": "Missing ids"})
+            return
+    except (ConnectionError, asyncio.IncompleteReadError):
+        writer.close()
+        return
+
+    subscriber = hub.subscribe(poster_ids)
+    try:
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"Connection: keep-alive\r\n"
+            b"Access-Control-Allow-Origin: *\r\n\r\n"
+            b"retry: 5000\n\n"
+        )
+        await writer.drain()
+        while True:
+            try:
+                await asyncio.wait_for(subscriber.event.wait(), KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                writer.write(b": keepalive\n\n")
+                await writer.drain()
+                continue
+            chunks = []
+            for counts in subscriber.drain().values():
+                chunks.append(f"event: counts\ndata: {json.dumps(counts)}\n\n")
+            writer.write("".join(chunks).encode("utf8"))
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        hub.unsubscribe(subscriber)
+        writer.close()
+
+
+async def serve(host=LIVE_HOST, port=LIVE_PORT):
+    """
+    Runs the live server and the hub flusher forever
+    """
+    server = await asyncio.start_server(handle_connection, host, port)
+    flusher = asyncio.ensure_future(hub.run_flusher())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        flusher.cancel()
+
+
+def start_live_server(host=LIVE_HOST, port=LIVE_PORT):
+    """
+    Starts the live server on its own event loop in a daemon thread
+    """
+    thread = threading.Thread(target=asyncio.run, args=(serve(host, port),), daemon=True)
+    thread.start()
+    return thread
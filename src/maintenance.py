@@ -0,0 +1,180 @@
+"""
+Maintenance job
+
+Keeps the hot tables small:
+1. Clears the session/update tokens of users whose session expired more than SESSION_RETENTION_DAYS ago
+2. Moves posters dated more than ARCHIVE_AFTER_DAYS ago, with their category links, saves and poster picture,
+   into the archive tables, and drops them from the users' inboxes
+3. Reclaims free pages with an incremental VACUUM and refreshes the planner statistics with ANALYZE
+
+Work is done in batches of MAINTENANCE_BATCH_SIZE rows, each in its own short transaction, so the SQLite write
+lock is never held for long.
+
+Incremental VACUUM needs the database in incremental auto-vacuum mode. Switching an existing database takes one
+full VACUUM, which locks it for as long as it takes to rewrite it, so it is a separate offline step
+(flask --app app enable-incremental-vacuum) that the scheduled job never runs.
+"""
+
+import datetime
+import os
+import threading
+import time
+
+import categories_dao
+from db import db
+from db import ArchivedAsset
+from db import ArchivedPoster
+from db import Asset
+from db import InboxItem
+from db import Poster
+from db import User
+from db import archived_posters_to_categories_association_table
+from db import archived_posters_to_users_association_table
+from db import posters_to_categories_association_table
+from db import posters_to_users_association_table
+
+SESSION_RETENTION_DAYS = int(os.environ.get("SESSION_RETENTION_DAYS", "30"))
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "90"))
+MAINTENANCE_BATCH_SIZE = int(os.environ.get("MAINTENANCE_BATCH_SIZE", "200"))
+MAINTENANCE_INTERVAL = int(os.environ.get("MAINTENANCE_INTERVAL", "3600"))
+MAINTENANCE_BATCH_PAUSE = 0.05
+VACUUM_PAGES = 1000
+INCREMENTAL_AUTO_VACUUM = 2
+
+# (live table, archive table, column linking rows to their poster)
+_ARCHIVED_TABLES = [
+    (posters_to_categories_association_table, archived_posters_to_categories_association_table, "poster_id"),
+    (posters_to_users_association_table, archived_posters_to_users_association_table, "poster_id"),
+    (Asset.__table__, ArchivedAsset.__table__, "poster_id"),
+    (Poster.__table__, ArchivedPoster.__table__, "id"),
+]
+
+
+def purge_expired_sessions(now=None):
+    """
+    Clears the tokens of sessions that expired more than SESSION_RETENTION_DAYS ago
+
+    Returns the number of users cleared
+    """
+    now = now or datetime.datetime.now()
+    cutoff = now - datetime.timedelta(days=SESSION_RETENTION_DAYS)
+    total = 0
+    while True:
+        ids = [
+            user_id for (user_id,) in
+            db.session.query(User.id)
+            .filter(User.session_expiration < cutoff, User.session_token != "")
+            .limit(MAINTENANCE_BATCH_SIZE)
+            .all()
+        ]
+        if not ids:
+            return total
+        User.query.filter(User.id.in_(ids)).update(
+            {User.session_token: "", User.update_token: ""},
+            synchronize_session=False
+        )
+        db.session.commit()
+        total += len(ids)
+        time.sleep(MAINTENANCE_BATCH_PAUSE)
+
+
+def archive_past_posters(now=None):
+    """
+    Moves posters dated more than ARCHIVE_AFTER_DAYS ago into the archive tables
+
+    Returns the number of posters archived
+    """
+    now = now or datetime.datetime.now()
+    cutoff = now - datetime.timedelta(days=ARCHIVE_AFTER_DAYS)
+    # posters leaving the table must already be out of the upcoming category counts
+    categories_dao.roll_category_counts()
+    # SQLite hands out max(id) + 1 for new rows, so the newest id is never archived to keep it from being reused
+    max_id = db.session.query(db.func.max(Poster.id)).scalar()
+    total = 0
+    while True:
+        ids = [
+            poster_id for (poster_id,) in
+            db.session.query(Poster.id)
+            .filter(Poster.date < cutoff, Poster.id != max_id)
+            .order_by(Poster.date)
+            .limit(MAINTENANCE_BATCH_SIZE)
+            .all()
+        ]
+        if not ids:
+            return total
+        # archive rows are copied before their parents and deleted after their children
+        for table, archive, column in _ARCHIVED_TABLES:
+            columns = [c.name for c in archive.columns]
+            db.session.execute(archive.insert().from_select(
+                columns,
+                db.select(*[table.c[name] for name in columns]).where(table.c[column].in_(ids))
+            ))
+        db.session.execute(InboxItem.__table__.delete().where(InboxItem.__table__.c.poster_id.in_(ids)))
+        for table, archive, column in _ARCHIVED_TABLES:
+            db.session.execute(table.delete().where(table.c[column].in_(ids)))
+        db.session.commit()
+        total += len(ids)
+        time.sleep(MAINTENANCE_BATCH_PAUSE)
+
+
+def compact_database():
+    """
+    Frees up to VACUUM_PAGES unused pages if the database is in incremental auto-vacuum mode, and refreshes the
+    planner statistics
+    """
+    if db.engine.dialect.name != "sqlite":
+        return
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() == INCREMENTAL_AUTO_VACUUM:
+            connection.exec_driver_sql(f"PRAGMA incremental_vacuum({VACUUM_PAGES})")
+        connection.exec_driver_sql("ANALYZE")
+
+
+def enable_incremental_vacuum():
+    """
+    Switches the database to incremental auto-vacuum with a full VACUUM. This rewrites the whole database under
+    an exclusive lock, so only run it offline or in a quiet window
+
+    Returns whether the database was switched
+    """
+    if db.engine.dialect.name != "sqlite":
+        return False
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() == INCREMENTAL_AUTO_VACUUM:
+            return False
+        connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        connection.exec_driver_sql("VACUUM")
+    return True
+
+
+def run_maintenance():
+    """
+    Runs every maintenance step once
+
+    Returns how many sessions were cleared and posters archived
+    """
+    now = datetime.datetime.now()
+    sessions = purge_expired_sessions(now)
+    posters = archive_past_posters(now)
+    compact_database()
+    return {"sessions_cleared": sessions, "posters_archived": posters}
+
+
+def start_maintenance_thread(app, interval=MAINTENANCE_INTERVAL):
+    """
+    Runs the maintenance job every interval seconds in a daemon thread
+    """
+    def loop():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    result = run_maintenance()
+                    print(f"Maintenance finished: {result}")
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Error while running maintenance: {e}")
+
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+    return thread
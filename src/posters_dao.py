@@ -0,0 +1,237 @@
+"""
+DAO (Data Access Object) file
+
+Helper file containing functions for accessing poster data in our database
+"""
+
+import datetime
+import threading
+import time
+
+from db import db
+from db import ArchivedPoster
+from db import Poster
+from db import archived_posters_to_users_association_table
+from db import posters_to_categories_association_table
+from db import posters_to_users_association_table
+from db import students_to_categories_association_table
+from sqlalchemy import event
+from sqlalchemy.orm import Session, attributes
+
+CALENDAR_GRANULARITIES = ["day", "week", "month"]
+CALENDAR_MAX_DAYS = 366
+CALENDAR_HOT_DAYS = 14
+CALENDAR_CACHE_TTL = 60
+
+# day -> (expires_at, serialized posters), only for days in the next CALENDAR_HOT_DAYS
+_calendar_cache = {}
+# day -> number of times the day was invalidated, so a read that raced with a commit does not cache stale posters
+_calendar_generations = {}
+_calendar_lock = threading.Lock()
+
+# poster fields that show up in a calendar bucket, likes/views are left to the cache TTL
+_CALENDAR_FIELDS = ["name", "author", "date", "location", "description", "user_id"]
+
+
+def ensure_poster_indexes():
+    """
+    Creates the indexes on the posters and category link tables if they are missing, db.create_all only does
+    this for new tables
+    """
+    for table in [Poster.__table__, posters_to_categories_association_table, students_to_categories_association_table]:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+def get_saved_posters_query(user_id):
+    """
+    Returns a query for the posters a user has saved
+    """
+    return Poster.query.join(
+        posters_to_users_association_table, posters_to_users_association_table.c.poster_id == Poster.id
+    ).filter(posters_to_users_association_table.c.user_id == user_id)
+
+
+def get_owned_posters_query(user_id):
+    """
+    Returns a query for the posters a user has created
+    """
+    return Poster.query.filter(Poster.user_id == user_id)
+
+
+def get_archived_saved_posters_query(user_id):
+    """
+    Returns a query for the archived posters a user had saved
+    """
+    return ArchivedPoster.query.join(
+        archived_posters_to_users_association_table,
+        archived_posters_to_users_association_table.c.poster_id == ArchivedPoster.id
+    ).filter(archived_posters_to_users_association_table.c.user_id == user_id)
+
+
+def get_archived_owned_posters_query(user_id):
+    """
+    Returns a query for the archived posters a user had created
+    """
+    return ArchivedPoster.query.filter(ArchivedPoster.user_id == user_id)
+
+
+def get_poster_by_id(id, include_archived=False):
+    """
+    Returns a poster given its id, looking in the archive too if include_archived is set
+    """
+    poster = Poster.query.filter_by(id=id).first()
+    if poster is None and include_archived:
+        poster = ArchivedPoster.query.filter_by(id=id).first()
+    return poster
+
+
+def _is_hot(day):
+    """
+    Returns whether a day's posters are kept in the calendar cache
+    """
+    today = datetime.date.today()
+    return today <= day < today + datetime.timedelta(days=CALENDAR_HOT_DAYS)
+
+
+def invalidate_calendar_days(days):
+    """
+    Drops the cached posters of the given days
+    """
+    with _calendar_lock:
+        for day in days:
+            _calendar_cache.pop(day, None)
+            _calendar_generations[day] = _calendar_generations.get(day, 0) + 1
+
+
+def _get_cached_day(day):
+    """
+    Returns the cached posters of a day, or None if they are not cached
+    """
+    with _calendar_lock:
+        entry = _calendar_cache.get(day)
+    if entry is None or entry[0] < time.monotonic():
+        return None
+    return entry[1]
+
+
+def _get_posters_by_day(start, end):
+    """
+    Returns the serialized posters on each day from start up to (not including) end, from one range scan of
+    the posters.date index
+    """
+    posters = (
+        Poster.query
+        .filter(Poster.date >= datetime.datetime.combine(start, datetime.time()))
+        .filter(Poster.date < datetime.datetime.combine(end, datetime.time()))
+        .order_by(Poster.date)
+        .all()
+    )
+    days = {}
+    for poster in posters:
+        days.setdefault(poster.date.date(), []).append(poster.simple_serialize())
+    return days
+
+
+def _bucket_start(day, granularity):
+    """
+    Returns the first day of the bucket a day falls in
+    """
+    if granularity == "week":
+        return day - datetime.timedelta(days=day.weekday())
+    if granularity == "month":
+        return day.replace(day=1)
+    return day
+
+
+def get_calendar(start, end, granularity="day"):
+    """
+    Returns the buckets of posters from start to end (both inclusive dates).
+
+    Every bucket has the number of posters in it. Day buckets also list their posters, week and month buckets
+    only count them so large ranges never load every poster. Posters of the next CALENDAR_HOT_DAYS days are cached.
+    """
+    day_end = end + datetime.timedelta(days=1)
+    counts = {}
+    rows = (
+        db.session.query(db.func.date(Poster.date), db.func.count())
+        .filter(Poster.date >= datetime.datetime.combine(start, datetime.time()))
+        .filter(Poster.date < datetime.datetime.combine(day_end, datetime.time()))
+        .group_by(db.func.date(Poster.date))
+        .all()
+    )
+    for day, count in rows:
+        counts[datetime.date.fromisoformat(day)] = count
+
+    posters = {}
+    if granularity == "day":
+        missing = []
+        for day in counts:
+            cached = _get_cached_day(day)
+            if cached is None:
+                missing.append(day)
+            else:
+                posters[day] = cached
+        if missing:
+            with _calendar_lock:
+                generations = {day: _calendar_generations.get(day, 0) for day in missing}
+            loaded = _get_posters_by_day(min(missing), max(missing) + datetime.timedelta(days=1))
+            expires_at = time.monotonic() + CALENDAR_CACHE_TTL
+            for day in missing:
+                posters[day] = loaded.get(day, [])
+                if _is_hot(day):
+                    with _calendar_lock:
+                        # skip days invalidated while they were being read, they may miss that commit
+                        if _calendar_generations.get(day, 0) == generations[day]:
+                            _calendar_cache[day] = (expires_at, posters[day])
+
+    buckets = []
+    day = start
+    while day <= end:
+        bucket_start = _bucket_start(day, granularity)
+        if not buckets or buckets[-1]["start"] != bucket_start:
+            buckets.append({"start": bucket_start, "count": 0})
+        buckets[-1]["count"] += counts.get(day, 0)
+        if granularity == "day":
+            buckets[-1]["posters"] = posters.get(day, [])
+        day += datetime.timedelta(days=1)
+    for bucket in buckets:
+        bucket["start"] = bucket["start"].isoformat()
+    return buckets
+
+
+@event.listens_for(Session, "after_flush")
+def collect_calendar_changes(session, flush_context):
+    """
+    Remembers the days of posters created, edited or deleted in this flush
+    """
+    days = session.info.setdefault("calendar_days", set())
+    for poster in list(session.new) + list(session.deleted):
+        if isinstance(poster, Poster) and poster.date is not None:
+            days.add(poster.date.date())
+    for poster in session.dirty:
+        if not isinstance(poster, Poster):
+            continue
+        state = attributes.instance_state(poster)
+        if not any(state.attrs[field].history.has_changes() for field in _CALENDAR_FIELDS):
+            continue
+        history = state.attrs.date.history
+        for date in list(history.deleted or ()) + [poster.date]:
+            if date is not None:
+                days.add(date.date())
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_calendar_changes(session):
+    """
+    Drops the cached days touched by the committed transaction
+    """
+    invalidate_calendar_days(session.info.pop("calendar_days", ()))
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def discard_calendar_changes(session, previous_transaction):
+    """
+    Forgets the days touched by a rolled back transaction
+    """
+    session.info.pop("calendar_days", None)
@@ -0,0 +1,217 @@
+"""
+Request profiler
+
+Opt-in sampling profiler for production requests. A request is profiled when it carries the
+X-Profile-Token header matching PROFILE_ADMIN_TOKEN, or at random for PROFILE_SAMPLE_RATE of requests.
+While a request is profiled a background thread samples its stack every PROFILE_INTERVAL seconds.
+
+Samples are aggregated per route and appended to PROFILE_DIR/<route>.<YYYYmmddHH>.folded in collapsed-stack
+format ("frame;frame;frame count"), ready for flamegraph.pl or speedscope. Overhead is capped by the number
+of requests profiled at once and per minute, disk use by PROFILE_MAX_FILES and PROFILE_MAX_BYTES.
+"""
+
+import collections
+import datetime
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+
+from flask import g, request
+
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_ADMIN_TOKEN = os.environ.get("PROFILE_ADMIN_TOKEN")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(os.getcwd(), "profiles"))
+PROFILE_INTERVAL = 0.005
+PROFILE_MAX_CONCURRENT = 2
+PROFILE_MAX_PER_MINUTE = 30
+PROFILE_FLUSH_INTERVAL = 30
+PROFILE_MAX_FILES = 200
+PROFILE_MAX_BYTES = 50 * 1024 * 1024
+PROFILE_EXTENSION = ".folded"
+
+
+def _frame_name(frame):
+    """
+    Returns the collapsed-stack name of a frame
+    """
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse_stack(frame):
+    """
+    Returns a frame's stack in collapsed-stack format, outermost frame first
+    """
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of the threads serving profiled requests and aggregates them per route
+    """
+
+    def __init__(self, directory=PROFILE_DIR):
+        """
+        Initialize SamplingProfiler object
+        """
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._active = {}
+        self._aggregates = collections.defaultdict(collections.Counter)
+        self._started = collections.deque()
+        self._last_flush = time.monotonic()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def should_sample(self):
+        """
+        Returns whether a request should be profiled at random
+        """
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    def start(self, route, forced=False):
+        """
+        Starts sampling the current thread for route. Returns False if the overhead caps are reached
+        """
+        now = time.monotonic()
+        with self._lock:
+            while self._started and self._started[0] < now - 60:
+                self._started.popleft()
+            if len(self._active) >= PROFILE_MAX_CONCURRENT:
+                return False
+            if not forced and len(self._started) >= PROFILE_MAX_PER_MINUTE:
+                return False
+            self._started.append(now)
+            self._active[threading.get_ident()] = (route, collections.Counter())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        return True
+
+    def stop(self):
+        """
+        Stops sampling the current thread and adds its samples to the route's aggregate
+        """
+        with self._lock:
+            entry = self._active.pop(threading.get_ident(), None)
+            if entry is None:
+                return
+            route, samples = entry
+            self._aggregates[route].update(samples)
+            if time.monotonic() - self._last_flush < PROFILE_FLUSH_INTERVAL:
+                return
+        self.flush()
+
+    def _run(self):
+        """
+        Sampler loop, sleeps while no request is being profiled
+        """
+        own_id = threading.get_ident()
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._wakeup.clear()
+            self._wakeup.wait()
+            time.sleep(PROFILE_INTERVAL)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, (route, samples) in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None and thread_id != own_id:
+                        samples[collapse_stack(frame)] += 1
+            del frames
+
+    def flush(self):
+        """
+        Appends the aggregated samples to each route's profile file for the current hour, then rotates
+        """
+        with self._lock:
+            aggregates = self._aggregates
+            self._aggregates = collections.defaultdict(collections.Counter)
+            self._last_flush = time.monotonic()
+        if not aggregates:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        hour = datetime.datetime.now().strftime("%Y%m%d%H")
+        for route, samples in aggregates.items():
+            safe_route = "".join(c if c.isalnum() or c == "_" else "_" for c in route)
+            path = os.path.join(self.directory, f"{safe_route}.{hour}{PROFILE_EXTENSION}")
+            with open(path, "a") as f:
+                for stack, count in samples.items():
+                    f.write(f"{stack} {count}\n")
+        self.rotate()
+
+    def rotate(self):
+        """
+        Deletes the oldest profile files until there are at most PROFILE_MAX_FILES using PROFILE_MAX_BYTES
+        """
+        profiles = self.list_profiles()
+        total = sum(p["size"] for p in profiles)
+        while profiles and (len(profiles) > PROFILE_MAX_FILES or total > PROFILE_MAX_BYTES):
+            oldest = profiles.pop()
+            total -= oldest["size"]
+            try:
+                os.remove(os.path.join(self.directory, oldest["name"]))
+            except FileNotFoundError:
+                pass
+
+    def list_profiles(self):
+        """
+        Returns the profile files, newest first
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        profiles = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(PROFILE_EXTENSION):
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            profiles.append({
+                "name": name,
+                "size": stat.st_size,
+                "modified_at": str(datetime.datetime.fromtimestamp(stat.st_mtime)),
+                "_mtime": stat.st_mtime
+            })
+        profiles.sort(key=lambda p: p["_mtime"], reverse=True)
+        for profile in profiles:
+            del profile["_mtime"]
+        return profiles
+
+
+profiler = SamplingProfiler()
+
+
+def start_request_profile():
+    """
+    before_request hook starting the profiler for sampled or admin requests
+    """
+    forced = is_profile_admin(request)
+    if request.endpoint is None or not (forced or profiler.should_sample()):
+        return
+    g.profiling = profiler.start(request.endpoint, forced)
+
+
+def stop_request_profile(exception=None):
+    """
+    teardown_request hook stopping the profiler
+    """
+    if g.pop("profiling", False):
+        profiler.stop()
+
+
+def is_profile_admin(req):
+    """
+    Returns whether a request carries the profiling admin token
+    """
+    if not PROFILE_ADMIN_TOKEN:
+        return False
+    token = req.headers.get("X-Profile-Token", "")
+    return hmac.compare_digest(token.encode("utf8"), PROFILE_ADMIN_TOKEN.encode("utf8"))
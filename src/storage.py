@@ -0,0 +1,129 @@
+"""
+Storage backends
+
+Where uploaded images are stored. STORAGE_BACKEND picks the backend:
+- "s3" (default): the S3_BUCKET_NAME bucket, through one pooled client per process
+- "local": files in LOCAL_STORAGE_DIR, served by the app under /uploads/ or by a static server.
+  LOCAL_STORAGE_BASE_URL is required and must be the absolute URL clients reach them at, e.g.
+  http://192.168.1.10:8000/uploads, since it is stored in every asset's URL
+"""
+
+from abc import ABC, abstractmethod
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+import os
+import threading
+from io import BytesIO
+from urllib.parse import urlsplit
+
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "s3")
+S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
+S3_REGION = os.environ.get("S3_REGION", "us-east-1")
+S3_MAX_POOL_CONNECTIONS = 20
+S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+LOCAL_STORAGE_DIR = os.environ.get("LOCAL_STORAGE_DIR", os.path.join(os.getcwd(), "uploads"))
+LOCAL_STORAGE_BASE_URL = os.environ.get("LOCAL_STORAGE_BASE_URL")
+
+
+class StorageBackend(ABC):
+    """
+    Interface for storage backends
+    """
+    base_url = None
+
+    @abstractmethod
+    def save(self, data, filename, content_type=None):
+        """
+        Stores data (bytes) under filename, making it publicly readable at f"{base_url}/{filename}"
+        """
+
+
+class S3Storage(StorageBackend):
+    """
+    Stores files in an S3 bucket. The boto3 client is created once per process and shared between threads,
+    so uploads reuse its connection pool
+    """
+
+    def __init__(self, bucket, region):
+        """
+        Initialize S3Storage object
+        """
+        self.bucket = bucket
+        self.region = region
+        self.base_url = f"https://{bucket}.s3.{region}.amazonaws.com"
+        self._client = None
+        self._client_pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        """
+        Returns the process' S3 client, creating it on first use (and again after a fork)
+        """
+        if self._client is None or self._client_pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._client_pid != os.getpid():
+                    self._client = boto3.client(
+                        "s3",
+                        region_name=self.region,
+                        config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
+                    )
+                    self._client_pid = os.getpid()
+        return self._client
+
+    def save(self, data, filename, content_type=None):
+        """
+        Uploads data from memory with a public-read ACL in the same request. Files over S3_MULTIPART_THRESHOLD
+        are uploaded in parts
+        """
+        extra_args = {"ACL": "public-read"}
+        if content_type is not None:
+            extra_args["ContentType"] = content_type
+        self.client.upload_fileobj(
+            BytesIO(data),
+            self.bucket,
+            filename,
+            ExtraArgs=extra_args,
+            Config=TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD)
+        )
+
+
+class LocalStorage(StorageBackend):
+    """
+    Stores files in a local directory, for development, tests and on-prem deployments
+    """
+
+    def __init__(self, directory, base_url):
+        """
+        Initialize LocalStorage object
+        """
+        url = urlsplit(base_url or "")
+        if url.scheme not in ("http", "https") or not url.netloc:
+            raise Exception("LOCAL_STORAGE_BASE_URL must be an absolute http(s) URL for the local storage backend")
+        self.directory = directory
+        self.base_url = base_url.rstrip("/")
+
+    def save(self, data, filename, content_type=None):
+        """
+        Writes data into the storage directory, going through a temporary file so readers never see half a file
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, os.path.basename(filename))
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+
+def create_storage():
+    """
+    Returns the backend configured by STORAGE_BACKEND
+    """
+    if STORAGE_BACKEND == "local":
+        return LocalStorage(LOCAL_STORAGE_DIR, LOCAL_STORAGE_BASE_URL)
+    if STORAGE_BACKEND == "s3":
+        return S3Storage(S3_BUCKET_NAME, S3_REGION)
+    raise Exception(f"Storage backend {STORAGE_BACKEND} not supported")
+
+
+storage = create_storage()
@@ -0,0 +1,173 @@
+"""
+Streaming and compressed responses
+
+Helper file for producing large JSON bodies piece by piece instead of building them in memory, and for
+compressing responses with gzip, or brotli when the brotli package is installed.
+"""
+
+import json
+import zlib
+
+from flask import Response, request, stream_with_context
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STREAM_CHUNK_SIZE = 500
+STREAM_BUFFER_SIZE = 16 * 1024
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSIBLE_TYPES = ["application/json", "text/"]
+
+
+def iter_rows(query, serialize, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Lazily serializes the rows of a query, fetching them from the cursor chunk_size rows at a time. The cursor
+    stays open while the response is sent, which relies on the WAL mode set up in db to not block writers
+    """
+    for row in query.yield_per(chunk_size):
+        yield serialize(row)
+
+
+def iter_json(value):
+    """
+    Encodes value as JSON piece by piece. Dicts and lists are encoded as usual, any other iterable
+    (e.g. a generator from iter_rows) is encoded as a list without being materialized
+    """
+    if isinstance(value, dict):
+        yield "{"
+        first = True
+        for key, item in value.items():
+            if not first:
+                yield ", "
+            first = False
+            yield json.dumps(str(key)) + ": "
+            yield from iter_json(item)
+        yield "}"
+    elif isinstance(value, (str, bytes, int, float, bool)) or value is None:
+        yield json.dumps(value)
+    elif hasattr(value, "__iter__"):
+        yield "["
+        first = True
+        for item in value:
+            if not first:
+                yield ", "
+            first = False
+            yield from iter_json(item)
+        yield "]"
+    else:
+        yield json.dumps(value)
+
+
+def _buffer(chunks, size=STREAM_BUFFER_SIZE):
+    """
+    Joins small string chunks into encoded blocks of about size bytes
+    """
+    buffer = []
+    length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield "".join(buffer).encode("utf8")
+            buffer = []
+            length = 0
+    if buffer:
+        yield "".join(buffer).encode("utf8")
+
+
+def stream_response(value, code=200):
+    """
+    Returns a streamed JSON response for value, see iter_json
+    """
+    return Response(
+        stream_with_context(_buffer(iter_json(value))),
+        status=code,
+        mimetype="application/json"
+    )
+
+
+def choose_encoding(accept_encoding):
+    """
+    Picks the best supported content encoding from an Accept-Encoding header, or None
+    """
+    supported = ["br", "gzip"] if brotli is not None else ["gzip"]
+    best = None
+    best_q = 0
+    for part in (accept_encoding or "").split(","):
+        params = part.strip().split(";")
+        coding = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            name, _, number = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(number)
+                except ValueError:
+                    q = 0
+        if coding == "*":
+            coding = supported[0]
+        if coding in supported and (q > best_q or (q == best_q and best is not None and
+                                                   supported.index(coding) < supported.index(best))):
+            best = coding
+            best_q = q
+    return best
+
+
+def _compressor(encoding):
+    """
+    Returns (compress, flush) functions for an encoding
+    """
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=5)
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress, compressor.flush
+
+
+def _iter_compressed(chunks, encoding):
+    """
+    Compresses a streamed body block by block
+    """
+    compress, flush = _compressor(encoding)
+    for chunk in chunks:
+        data = compress(chunk if isinstance(chunk, bytes) else chunk.encode("utf8"))
+        if data:
+            yield data
+    yield flush()
+
+
+def compress_response(response):
+    """
+    after_request hook compressing responses the client accepts an encoding for. Streamed responses are
+    compressed as they are sent, other responses only when they are at least COMPRESSION_MIN_SIZE bytes.
+    File responses (direct_passthrough) and partial responses are left alone, since compressing them would
+    break byte ranges
+    """
+    response.vary.add("Accept-Encoding")
+    if response.status_code < 200 or response.status_code >= 300 or "Content-Encoding" in response.headers:
+        return response
+    if response.direct_passthrough or response.status_code == 206 or "Content-Range" in response.headers:
+        return response
+    if not any(response.mimetype.startswith(t) for t in COMPRESSIBLE_TYPES):
+        return response
+    encoding = choose_encoding(request.headers.get("Accept-Encoding"))
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _iter_compressed(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE:
+            return response
+        compress, flush = _compressor(encoding)
+        response.set_data(compress(data) + flush())
+    response.headers["Content-Encoding"] = encoding
+    # the compressed body differs byte for byte from the identity one, so a strong ETag no longer holds
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response